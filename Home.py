@@ -3,6 +3,7 @@ from lib.ui import inject_css
 from lib.auth import login_view
 from lib.clients import get_config
 from lib.storage import get_student_dataframes
+from lib.quota import get_governor
 
 st.set_page_config(page_title="LLM Coursework Helper", layout="wide")
 
@@ -93,5 +94,10 @@ with c3:
         drafts_df, events_df = get_student_dataframes()
         st.write(f"Draft records: **{len(drafts_df)}**")
         st.write(f"Event turns: **{len(events_df)}**")
+        q = get_governor().stats()
+        st.caption(
+            f"Sheets API — reads: {q['reads']} (coalesced {q['coalesced']}), writes: {q['writes']}, "
+            f"429 retries: {q['retries']}, throttled: {q['throttled_seconds']}s"
+        )
     except Exception as e:
         st.warning(f"Could not fetch workbook stats: {e}")
@@ -25,6 +25,13 @@ def _as_plain(obj):
         return [_as_plain(v) for v in obj]
     return obj
 
+# Similarity segment sizes; kept here so config can validate without importing lib.similarity (SBERT).
+SIM_GRANULARITIES = ("paragraph", "sentence")
+
+def _choice(value, allowed, default):
+    value = (value or "").strip().lower()
+    return value if value in allowed else default
+
 @st.cache_resource
 def get_config():
     return {
@@ -33,7 +40,18 @@ def get_config():
         "SPREADSHEET_KEY":   os.getenv("SPREADSHEET_KEY")   or st.secrets.get("env", {}).get("SPREADSHEET_KEY"),
         "ASSIGNMENT_DEFAULT": os.getenv("ASSIGNMENT_ID", "GENERIC"),
         "SIM_THRESHOLD": float(os.getenv("SIM_THRESHOLD", "0.85")),
+        "SIM_GRANULARITY": _choice(os.getenv("SIM_GRANULARITY"), SIM_GRANULARITIES, "paragraph"),
+        "SIM_TOP_K": int(os.getenv("SIM_TOP_K", "3")),
+        "SIM_BLOCK_SIZE": int(os.getenv("SIM_BLOCK_SIZE", "256")),
+        "SIM_EVENTS_REFRESH_SECONDS": int(os.getenv("SIM_EVENTS_REFRESH_SECONDS", "60")),
         "AUTO_SAVE_SECONDS": int(os.getenv("AUTO_SAVE_SECONDS", "60")),
+        "SHEETS_READS_PER_MIN": int(os.getenv("SHEETS_READS_PER_MIN", "60")),
+        "SHEETS_WRITES_PER_MIN": int(os.getenv("SHEETS_WRITES_PER_MIN", "60")),
+        "SHEETS_MAX_RETRIES": int(os.getenv("SHEETS_MAX_RETRIES", "5")),
+        "CONTEXT_TOKEN_BUDGET": int(os.getenv("CONTEXT_TOKEN_BUDGET", "4000")),
+        "SEARCH_INDEX_PATH": os.getenv("SEARCH_INDEX_PATH", ".cache/search_index.sqlite"),
+        "SESSION_SPILL_PATH": os.getenv("SESSION_SPILL_PATH", ".cache/sessions.sqlite"),
+        "SESSION_WINDOW_MESSAGES": int(os.getenv("SESSION_WINDOW_MESSAGES", "40")),
     }
 
 @st.cache_resource
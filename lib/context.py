@@ -0,0 +1,118 @@
+# lib/context.py
+import re
+import streamlit as st
+
+# Rough Gemini/SentencePiece ratio; good enough for budgeting without an API round-trip.
+CHARS_PER_TOKEN = 4
+
+PREAMBLE = ("You are a writing assistant helping a student with coursework. "
+            "Use the context below when it is relevant.")
+SUMMARY_HEADING = "## Earlier conversation (summary)\n"
+DRAFT_HEADING = "## Student's current draft\n"
+RECENT_HEADING = "## Recent conversation\n"
+PROMPT_HEADING = "## Student's new message\n"
+SEP = "\n\n"
+
+def estimate_tokens(text: str) -> int:
+    return (len(text or "") + CHARS_PER_TOKEN - 1) // CHARS_PER_TOKEN
+
+# Preamble, headings and the separator in front of each section. Summing per-part
+# estimates never undercounts the estimate of the joined text.
+_OVERHEAD_TOKENS = estimate_tokens(PREAMBLE) + sum(
+    estimate_tokens(SEP + h) for h in (SUMMARY_HEADING, DRAFT_HEADING, RECENT_HEADING, PROMPT_HEADING)
+)
+
+def trim_to_tokens(text: str, budget: int, keep="head") -> str:
+    """Clip `text` so that estimate_tokens() of the result, ellipsis included, is at most `budget`."""
+    text = text or ""
+    limit = max(0, budget) * CHARS_PER_TOKEN
+    if len(text) <= limit:
+        return text
+    limit = max(0, limit - 2)
+    if keep == "tail":
+        return "… " + text[len(text) - limit:] if limit else ""
+    return text[:limit] + " …" if limit else ""
+
+def _lead(text: str, max_chars=160) -> str:
+    """First sentence of a message, single-lined and clipped."""
+    t = re.sub(r"\s+", " ", text or "").strip()
+    m = re.match(r"(.+?[.!?])(\s|$)", t)
+    t = m.group(1) if m else t
+    return t if len(t) <= max_chars else t[:max_chars] + " …"
+
+def _fold(summary: str, messages) -> str:
+    lines = [summary] if summary else []
+    for m in messages:
+        who = "Student" if m["role"] == "user" else "Assistant"
+        lines.append(f"- {who}: {_lead(m['text'])}")
+    return "\n".join(lines)
+
+def _rolling_summary(history, upto: int, budget: int) -> str:
+    """Summary of history[:upto], extended incrementally and cached in session state."""
+    if upto <= 0:
+        return ""
+    cache = st.session_state.get("context_summary") or {"upto": 0, "text": ""}
+    if cache["upto"] > upto or cache["upto"] > len(history):
+        cache = {"upto": 0, "text": ""}  # chat was cleared or rewound
+    if cache["upto"] < upto:
+        text = _fold(cache["text"], history[cache["upto"]:upto])
+        # Oldest lines drop off first so the summary stays bounded.
+        while estimate_tokens(text) > budget and "\n" in text:
+            text = text.split("\n", 1)[1]
+        cache = {"upto": upto, "text": trim_to_tokens(text, budget, keep="tail")}
+        st.session_state["context_summary"] = cache
+    return cache["text"]
+
+def build_context(prompt: str, history, draft_text: str, budget: int):
+    """Assemble a bounded prompt from the draft, earlier turns and the new prompt.
+
+    The new message is capped at half the budget. Recent turns are kept
+    verbatim, newest first, until the budget runs out; older turns are folded
+    into a rolling summary. Returns (text, token_counts).
+    """
+    available = max(0, budget - _OVERHEAD_TOKENS)
+    prompt_budget = available // 2
+    summary_budget = available // 6
+    draft_budget = available // 4
+
+    raw_prompt_tokens = estimate_tokens(prompt)
+    prompt = trim_to_tokens(prompt, prompt_budget)
+    prompt_tokens = estimate_tokens(prompt)
+
+    draft = trim_to_tokens((draft_text or "").strip(), draft_budget)
+    draft_tokens = estimate_tokens(draft)
+
+    remaining = available - prompt_tokens - draft_tokens - summary_budget
+    recent, start = [], len(history)
+    for i in range(len(history) - 1, -1, -1):
+        m = history[i]
+        who = "Student" if m["role"] == "user" else "Assistant"
+        line = f"{who}: {m['text']}"
+        cost = estimate_tokens(line + SEP)
+        if cost > remaining:
+            break
+        recent.append(line)
+        remaining -= cost
+        start = i
+    recent.reverse()
+
+    summary = _rolling_summary(history, start, summary_budget)
+
+    parts = [PREAMBLE]
+    if summary:
+        parts.append(SUMMARY_HEADING + summary)
+    if draft:
+        parts.append(DRAFT_HEADING + draft)
+    if recent:
+        parts.append(RECENT_HEADING + SEP.join(recent))
+    parts.append(PROMPT_HEADING + prompt)
+    text = SEP.join(parts)
+
+    counts = {
+        "raw_prompt_tokens": raw_prompt_tokens,
+        "prompt_tokens": prompt_tokens,
+        "context_tokens": estimate_tokens(text),
+        "verbatim_turns": len(recent),
+        "summarised_turns": start,
+    }
+    return text, counts
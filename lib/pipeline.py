@@ -0,0 +1,151 @@
+# lib/pipeline.py
+import datetime, logging, threading, time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+import streamlit as st
+from lib.clients import get_config
+from lib.session_store import text_hash
+from lib.similarity import SIM_BACKEND, embed, segment, top_k_similarities
+from lib.storage import (
+    EVENTS_HEADERS, append_row, get_or_create_worksheets, get_records, get_similarity_worksheet,
+)
+
+log = logging.getLogger(__name__)
+
+class SimilarityPipeline:
+    """Background stage that scores each saved draft snapshot against the student's logged responses.
+
+    Per (student, assignment) it remembers the best score of every draft
+    segment and how many response segments it has already seen, so a save
+    only scores new or edited segments against all responses, and unchanged
+    segments against responses logged since the previous save. (With the
+    TF-IDF backend, reused scores keep the vocabulary they were computed with.)
+
+    Saves are coalesced: while a student's snapshot is waiting, a newer save
+    replaces it, so the queue holds at most one job per (student, assignment).
+    With SBERT, segment embeddings are cached by text hash, so unchanged
+    responses and draft segments are not re-encoded.
+    """
+
+    def __init__(self, threshold=0.85, granularity="paragraph", refresh_seconds=60, max_students=500, block=256,
+                 max_vectors=20000):
+        self.threshold = threshold
+        self.block = block
+        self.granularity = granularity
+        self.refresh_seconds = refresh_seconds
+        self.max_students = max_students
+        self.executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="similarity")
+        self._state = OrderedDict()  # (user_id, assignment_id) -> {"n_llm": int, "scores": {hash: score}}
+        self._events = (0.0, None)
+        self._lock = threading.Lock()
+        self._pending = {}  # (user_id, assignment_id) -> (draft_text, snapshot_at), latest save only
+        self._pending_lock = threading.Lock()
+        self._vectors = OrderedDict()  # text_hash -> embedding (SBERT only), LRU
+        self.max_vectors = max_vectors
+
+    def submit(self, user_id, assignment_id, draft_text, snapshot_at):
+        key = (user_id, assignment_id)
+        with self._pending_lock:
+            queued = key in self._pending
+            self._pending[key] = (draft_text, snapshot_at)
+        if not queued:
+            self.executor.submit(self._drain, key)
+
+    def _drain(self, key):
+        with self._pending_lock:
+            job = self._pending.pop(key, None)
+        if job is not None:
+            self._run(*key, *job)
+
+    def _embeddings(self, texts):
+        """Cached SBERT embeddings for `texts`, encoding only those not seen before."""
+        hashes = [text_hash(t) for t in texts]
+        missing = {h: t for h, t in zip(hashes, texts) if h not in self._vectors}
+        if missing:
+            self._vectors.update(zip(missing, embed(missing.values())))
+        for h in hashes:
+            self._vectors.move_to_end(h)
+        while len(self._vectors) > max(self.max_vectors, len(hashes)):
+            self._vectors.popitem(last=False)
+        return np.stack([self._vectors[h] for h in hashes])
+
+    def _top1(self, finals, llm_segs):
+        embeddings = None
+        if SIM_BACKEND == "sbert":
+            embeddings = (self._embeddings(finals), self._embeddings(llm_segs))
+        s, _ = top_k_similarities(finals, llm_segs, k=1, block=self.block, embeddings=embeddings)
+        return s[:, 0].tolist()
+
+    def _responses(self, user_id, assignment_id):
+        with self._lock:
+            fetched, recs = self._events
+            if recs is None or time.monotonic() - fetched > self.refresh_seconds:
+                events_ws, _ = get_or_create_worksheets()
+                recs = get_records(events_ws, EVENTS_HEADERS)
+                self._events = (time.monotonic(), recs)
+        uid, aid = str(user_id).strip().upper(), str(assignment_id).strip()
+        return [str(r.get("response", "")) for r in recs
+                if str(r.get("user_id", "")).strip().upper() == uid and str(r.get("assignment_id", "")).strip() == aid]
+
+    def _run(self, user_id, assignment_id, draft_text, snapshot_at):
+        try:
+            row = self.score(user_id, assignment_id, draft_text)
+            # No script context on this thread, so st.* can't report failures; let them reach the log.
+            append_row(get_similarity_worksheet(), [
+                user_id, assignment_id, snapshot_at,
+                row["mean"], row["high_share"], row["segments"], row["changed_segments"],
+                SIM_BACKEND, datetime.datetime.now().isoformat(),
+            ])
+        except Exception:
+            log.exception("Similarity stage failed for %s/%s", user_id, assignment_id)
+
+    def score(self, user_id, assignment_id, draft_text):
+        finals = segment(draft_text, self.granularity)
+        llm_segs = [s for t in self._responses(user_id, assignment_id) for s in segment(t, self.granularity)]
+
+        key = (user_id, assignment_id)
+        state = self._state.pop(key, None) or {"n_llm": 0, "scores": {}}
+        if len(llm_segs) < state["n_llm"]:
+            state = {"n_llm": 0, "scores": {}}  # events sheet was trimmed
+
+        hashes = [text_hash(f) for f in finals]
+        unique = dict(zip(hashes, finals))
+        known = {h: state["scores"][h] for h in unique if h in state["scores"]}
+        changed = [h for h in unique if h not in known]
+
+        scores = {}
+        if llm_segs and changed:
+            scores.update(zip(changed, self._top1([unique[h] for h in changed], llm_segs)))
+        new_llm = llm_segs[state["n_llm"]:]
+        if new_llm and known:
+            fresh = self._top1([unique[h] for h in known], new_llm)
+            scores.update((h, max(known[h], v)) for h, v in zip(known, fresh))
+        else:
+            scores.update(known)
+
+        self._state[key] = {"n_llm": len(llm_segs), "scores": scores}
+        while len(self._state) > self.max_students:
+            self._state.popitem(last=False)
+
+        if not finals or not llm_segs:
+            return {"mean": 0.0, "high_share": 0.0, "segments": len(finals), "changed_segments": len(changed)}
+        per_seg = [scores[h] for h in hashes]
+        total_tokens = sum(len(f.split()) for f in finals)
+        high_tokens = sum(len(f.split()) for f, s in zip(finals, per_seg) if s >= self.threshold)
+        return {
+            "mean": round(sum(per_seg) / len(per_seg), 3),
+            "high_share": round(high_tokens / max(1, total_tokens), 3),
+            "segments": len(finals),
+            "changed_segments": len(changed),
+        }
+
+@st.cache_resource
+def get_pipeline():
+    cfg = get_config()
+    return SimilarityPipeline(
+        threshold=cfg["SIM_THRESHOLD"],
+        granularity=cfg["SIM_GRANULARITY"],
+        refresh_seconds=cfg["SIM_EVENTS_REFRESH_SECONDS"],
+        block=cfg["SIM_BLOCK_SIZE"],
+    )
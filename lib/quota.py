@@ -0,0 +1,146 @@
+# lib/quota.py
+import random, threading, time
+import streamlit as st
+from lib.clients import get_config
+
+try:
+    from gspread.exceptions import APIError
+except Exception:
+    APIError = None
+
+def is_quota_error(e) -> bool:
+    """True for Sheets '429 RESOURCE_EXHAUSTED' (rate limit) errors."""
+    if APIError is not None:
+        if not isinstance(e, APIError):
+            return False
+        code = getattr(e, "code", None)
+        if code is None:
+            code = getattr(getattr(e, "response", None), "status_code", None)
+        return code == 429
+    # Without gspread there is no typed error to inspect; fall back to the message.
+    return "429" in str(e) or "RESOURCE_EXHAUSTED" in str(e)
+
+class TokenBucket:
+    """Blocking token bucket: `per_minute` tokens refilled continuously, burst up to `capacity`."""
+
+    def __init__(self, per_minute: int, capacity: int = None):
+        self.rate = max(1, per_minute) / 60.0
+        self.capacity = float(capacity or max(1, per_minute))
+        self.tokens = self.capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def acquire(self) -> float:
+        """Take one token, sleeping until one is available. Returns seconds waited."""
+        waited = 0.0
+        while True:
+            with self.lock:
+                now = time.monotonic()
+                self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1.0:
+                    self.tokens -= 1.0
+                    return waited
+                delay = (1.0 - self.tokens) / self.rate
+            time.sleep(delay)
+            waited += delay
+
+class _Flight:
+    __slots__ = ("done", "result", "error")
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SheetsGovernor:
+    """Process-wide guard around gspread calls.
+
+    Identical in-flight reads share one request (single-flight), reads and
+    writes draw from separate token buckets, and 429s are retried with
+    exponential backoff and jitter.
+    """
+
+    def __init__(self, reads_per_min=60, writes_per_min=60, max_retries=5, backoff_base=1.0):
+        self.read_bucket = TokenBucket(reads_per_min)
+        self.write_bucket = TokenBucket(writes_per_min)
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self._flights = {}
+        self._flights_lock = threading.Lock()
+        self._stats_lock = threading.Lock()
+        self._stats = {
+            "reads": 0, "writes": 0, "coalesced": 0,
+            "retries": 0, "quota_errors": 0, "failures": 0,
+            "throttled_seconds": 0.0,
+        }
+
+    def _count(self, key, n=1):
+        with self._stats_lock:
+            self._stats[key] += n
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            out = dict(self._stats)
+        out["throttled_seconds"] = round(out["throttled_seconds"], 2)
+        out["read_tokens"] = round(self.read_bucket.tokens, 1)
+        out["write_tokens"] = round(self.write_bucket.tokens, 1)
+        return out
+
+    def _call(self, bucket, counter, fn, *args, **kwargs):
+        attempt = 0
+        while True:
+            waited = bucket.acquire()
+            if waited:
+                self._count("throttled_seconds", waited)
+            self._count(counter)
+            try:
+                return fn(*args, **kwargs)
+            except Exception as e:
+                if not is_quota_error(e):
+                    self._count("failures")
+                    raise
+                self._count("quota_errors")
+                if attempt >= self.max_retries:
+                    self._count("failures")
+                    raise
+                delay = self.backoff_base * (2 ** attempt) + random.uniform(0, self.backoff_base)
+                attempt += 1
+                self._count("retries")
+                time.sleep(min(delay, 64.0))
+
+    def write(self, fn, *args, **kwargs):
+        return self._call(self.write_bucket, "writes", fn, *args, **kwargs)
+
+    def read(self, key, fn, *args, **kwargs):
+        """Run a read; concurrent callers with the same `key` wait for and share one result."""
+        with self._flights_lock:
+            flight = self._flights.get(key)
+            leader = flight is None
+            if leader:
+                flight = self._flights[key] = _Flight()
+        if not leader:
+            self._count("coalesced")
+            flight.done.wait()
+            if flight.error is not None:
+                raise flight.error
+            return flight.result
+        try:
+            flight.result = self._call(self.read_bucket, "reads", fn, *args, **kwargs)
+            return flight.result
+        except Exception as e:
+            flight.error = e
+            raise
+        finally:
+            with self._flights_lock:
+                self._flights.pop(key, None)
+            flight.done.set()
+
+@st.cache_resource
+def get_governor():
+    cfg = get_config()
+    return SheetsGovernor(
+        reads_per_min=cfg["SHEETS_READS_PER_MIN"],
+        writes_per_min=cfg["SHEETS_WRITES_PER_MIN"],
+        max_retries=cfg["SHEETS_MAX_RETRIES"],
+    )
@@ -0,0 +1,251 @@
+# lib/search.py
+import datetime, heapq, math, os, re, sqlite3, threading
+from array import array
+from contextlib import contextmanager
+import streamlit as st
+from lib.clients import get_config
+
+FIELDS = ("prompt", "response")
+_TOKEN = re.compile(r"\w+")
+_QUERY = re.compile(r'"([^"]+)"|(\S+)')
+
+def tokenize(text: str):
+    return _TOKEN.findall(str(text or "").lower())
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS meta     (key TEXT PRIMARY KEY, value TEXT);
+CREATE TABLE IF NOT EXISTS docs     (doc_id INTEGER PRIMARY KEY, row INTEGER, field TEXT, user_id TEXT,
+                                     assignment_id TEXT, timestamp TEXT, turn TEXT, length INTEGER);
+CREATE TABLE IF NOT EXISTS postings (term TEXT, doc_id INTEGER, positions BLOB);
+"""
+_TERM_INDEX = "CREATE INDEX IF NOT EXISTS postings_term ON postings (term)"
+
+@contextmanager
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        conn.execute("PRAGMA synchronous=NORMAL")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+class SearchIndex:
+    """Positional inverted index over the `prompt` and `response` columns of the events sheet.
+
+    Each (row, field) pair is a document. Postings live in an append-only
+    SQLite table at `path`; only document metadata is held in memory, and a
+    query reads just the postings of its own terms. The events sheet is
+    append-only, so `sync` inserts only rows beyond `n_rows`. Ranking is BM25;
+    quoted phrases must match exactly, bare tokens are OR-ed.
+    """
+
+    VERSION = 2
+    K1, B = 1.2, 0.75
+
+    def __init__(self, path, source=None):
+        self.path = path
+        self.source = source  # spreadsheet key the postings were built from
+        self.lock = threading.Lock()        # guards the in-memory doc metadata
+        self._sync_lock = threading.Lock()  # one writer at a time
+        self._reset()
+
+    def _reset(self):
+        self.n_rows = 0
+        self.docs = []       # doc_id -> (row, field, user_id, assignment_id, timestamp, turn)
+        self.lengths = []    # doc_id -> token count
+        self.total_len = 0
+
+    # --- persistence ---
+    def _clear(self, conn):
+        conn.execute("DELETE FROM postings")
+        conn.execute("DELETE FROM docs")
+        conn.execute("DELETE FROM meta")
+        conn.executemany("INSERT INTO meta VALUES (?, ?)",
+                         [("version", str(self.VERSION)), ("source", str(self.source)), ("n_rows", "0")])
+        with self.lock:
+            self._reset()
+
+    def load(self):
+        os.makedirs(os.path.dirname(self.path) or ".", exist_ok=True)
+        with _connect(self.path) as conn:
+            conn.executescript(_SCHEMA)
+            conn.execute(_TERM_INDEX)
+            meta = dict(conn.execute("SELECT key, value FROM meta"))
+            # Row numbers are only meaningful for the workbook they came from.
+            if meta.get("version") != str(self.VERSION) or meta.get("source") != str(self.source):
+                self._clear(conn)
+                return self
+            rows = conn.execute(
+                "SELECT row, field, user_id, assignment_id, timestamp, turn, length FROM docs ORDER BY doc_id"
+            ).fetchall()
+        with self.lock:
+            self.docs = [r[:6] for r in rows]
+            self.lengths = [r[6] for r in rows]
+            self.total_len = sum(self.lengths)
+            self.n_rows = int(meta.get("n_rows", 0))
+        return self
+
+    # --- indexing ---
+    def sync(self, events_df) -> int:
+        """Index rows added since the last sync; rebuilds if the sheet shrank. Returns rows added.
+
+        If another session is already syncing, returns 0 immediately rather than waiting.
+        """
+        if not self._sync_lock.acquire(blocking=False):
+            return 0
+        try:
+            if len(events_df) < self.n_rows:
+                with _connect(self.path) as conn:
+                    self._clear(conn)
+            new = events_df.iloc[self.n_rows:]
+            if new.empty:
+                return 0
+
+            base = len(self.docs)
+            docs, postings = [], []
+            for row, rec in zip(range(self.n_rows, len(events_df)), new.to_dict("records")):
+                for field in FIELDS:
+                    terms = tokenize(rec.get(field, ""))
+                    positions = {}
+                    for pos, term in enumerate(terms):
+                        positions.setdefault(term, array("I")).append(pos)
+                    doc_id = base + len(docs)
+                    docs.append((doc_id, row, field, str(rec.get("user_id", "")), str(rec.get("assignment_id", "")),
+                                 str(rec.get("timestamp", "")), str(rec.get("turn", "")), len(terms)))
+                    postings.extend((t, doc_id, p.tobytes()) for t, p in positions.items())
+
+            with _connect(self.path) as conn:
+                conn.executemany("INSERT INTO docs VALUES (?, ?, ?, ?, ?, ?, ?, ?)", docs)
+                # Bulk-loading into an empty table is much faster with the term index built afterwards.
+                if base == 0:
+                    conn.execute("DROP INDEX IF EXISTS postings_term")
+                conn.executemany("INSERT INTO postings VALUES (?, ?, ?)", postings)
+                conn.execute(_TERM_INDEX)
+                conn.execute("INSERT OR REPLACE INTO meta VALUES ('n_rows', ?)", (str(len(events_df)),))
+            with self.lock:
+                self.docs.extend(d[1:7] for d in docs)
+                self.lengths.extend(d[7] for d in docs)
+                self.total_len += sum(d[7] for d in docs)
+                self.n_rows = len(events_df)
+            return len(new)
+        finally:
+            self._sync_lock.release()
+
+    @property
+    def syncing(self) -> bool:
+        return self._sync_lock.locked()
+
+    def sync_in_background(self, events_df):
+        """Start `sync` on a daemon thread unless one is already running; searches keep serving meanwhile."""
+        if not self.syncing:
+            threading.Thread(target=self.sync, args=(events_df,), name="search-sync", daemon=True).start()
+
+    # --- querying ---
+    def _postings(self, terms, n_docs):
+        """{term: {doc_id: packed positions}} for `terms`, limited to docs visible in memory."""
+        terms = list(terms)
+        out = {t: {} for t in terms}
+        with _connect(self.path) as conn:
+            rows = conn.execute(
+                f"SELECT term, doc_id, positions FROM postings WHERE term IN ({','.join('?' * len(terms))})",
+                terms,
+            )
+            for term, doc_id, blob in rows:
+                if doc_id < n_docs:
+                    out[term][doc_id] = blob
+        return out
+
+    @staticmethod
+    def _phrase_docs(postings, terms):
+        lists = [postings.get(t) for t in terms]
+        if not all(lists):
+            return set()
+        cands = set.intersection(*(set(p) for p in lists))
+        if len(terms) == 1:
+            return cands
+        hits = set()
+        for d in cands:
+            first = array("I", lists[0][d])
+            rest = [set(array("I", p[d])) for p in lists[1:]]
+            if any(all(start + i + 1 in s for i, s in enumerate(rest)) for start in first):
+                hits.add(d)
+        return hits
+
+    @staticmethod
+    def _keep(meta, field, assignment, since, until):
+        _, f, _, aid, ts, _ = meta
+        if field and f != field:
+            return False
+        if assignment and aid != assignment:
+            return False
+        if since and ts < since:
+            return False
+        if until and ts >= until:
+            return False
+        return True
+
+    def search(self, query, field=None, assignment=None, date_from=None, date_to=None, limit=50):
+        """Return up to `limit` hits as dicts, best BM25 score first.
+
+        `date_from`/`date_to` are inclusive `datetime.date`s compared against
+        the ISO timestamps written by `log_turn_row`.
+        """
+        phrases, tokens = [], []
+        for phrase, word in _QUERY.findall(query or ""):
+            if phrase:
+                terms = tokenize(phrase)
+                if terms:
+                    phrases.append(terms)
+            else:
+                tokens.extend(tokenize(word))
+        terms = set(tokens).union(*phrases) if phrases else set(tokens)
+        if not terms:
+            return []
+
+        since = date_from.isoformat() if date_from else None
+        until = (date_to + datetime.timedelta(days=1)).isoformat() if date_to else None
+
+        # Sync only appends, so a snapshot of the first n docs stays consistent without holding the lock.
+        with self.lock:
+            docs, lengths, total_len = self.docs, self.lengths, self.total_len
+            n = len(docs)
+        postings = self._postings(terms, n)
+
+        if phrases:
+            cands = set.intersection(*(self._phrase_docs(postings, p) for p in phrases))
+        else:
+            cands = set().union(*(postings[t].keys() for t in terms))
+        cands = [d for d in cands if self._keep(docs[d], field, assignment, since, until)]
+        if not cands:
+            return []
+
+        avgdl = total_len / max(1, n)
+        width = array("I").itemsize
+        idf = {}
+        for t in terms:
+            df = len(postings[t])
+            idf[t] = math.log(1 + (n - df + 0.5) / (df + 0.5))
+
+        def score(d):
+            norm = self.K1 * (1 - self.B + self.B * lengths[d] / max(1e-9, avgdl))
+            s = 0.0
+            for t in terms:
+                tf = len(postings[t].get(d, b"")) // width
+                if tf:
+                    s += idf[t] * tf * (self.K1 + 1) / (tf + norm)
+            return s
+
+        best = heapq.nlargest(limit, ((score(d), d) for d in cands))
+        out = []
+        for s, d in best:
+            row, f, uid, aid, ts, turn = docs[d]
+            out.append({"row": row, "field": f, "user_id": uid, "assignment_id": aid,
+                        "timestamp": ts, "turn": turn, "score": round(s, 3)})
+        return out
+
+@st.cache_resource
+def get_search_index():
+    cfg = get_config()
+    return SearchIndex(cfg["SEARCH_INDEX_PATH"], source=cfg["SPREADSHEET_KEY"]).load()
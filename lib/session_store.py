@@ -0,0 +1,186 @@
+# lib/session_store.py
+import datetime, hashlib, json, os, sqlite3, uuid, weakref
+from collections import Counter, deque
+from contextlib import contextmanager
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS texts    (hash TEXT PRIMARY KEY, body TEXT NOT NULL);
+CREATE TABLE IF NOT EXISTS messages (session TEXT, seq INTEGER, role TEXT, ts TEXT, hash TEXT,
+                                     PRIMARY KEY (session, seq));
+CREATE TABLE IF NOT EXISTS blobs    (session TEXT, name TEXT, body TEXT, PRIMARY KEY (session, name));
+"""
+
+def text_hash(text: str) -> str:
+    return hashlib.blake2b((text or "").encode("utf-8"), digest_size=16).hexdigest()
+
+@contextmanager
+def _connect(path):
+    conn = sqlite3.connect(path, timeout=30)
+    try:
+        conn.execute("PRAGMA journal_mode=WAL")
+        with conn:
+            yield conn
+    finally:
+        conn.close()
+
+def _purge(path, session):
+    try:
+        with _connect(path) as conn:
+            conn.execute("DELETE FROM messages WHERE session=?", (session,))
+            conn.execute("DELETE FROM blobs WHERE session=?", (session,))
+            conn.execute("DELETE FROM texts WHERE hash NOT IN (SELECT hash FROM messages)")
+    except Exception:
+        pass
+
+class Message:
+    """One chat turn. `text` is shared with every other message carrying the same hash."""
+    __slots__ = ("role", "text", "ref", "ts")
+
+    def __init__(self, role, text, ref, ts):
+        self.role, self.text, self.ref, self.ts = role, text, ref, ts
+
+    def __getitem__(self, key):
+        # Lets callers keep the {"role": ..., "text": ...} access style.
+        return getattr(self, key)
+
+    def get(self, key, default=None):
+        return getattr(self, key, default)
+
+class _View:
+    """The first `stop` messages of a store, without rehydrating them."""
+    __slots__ = ("store", "stop")
+
+    def __init__(self, store, stop):
+        self.store, self.stop = store, max(0, stop)
+
+    def __len__(self):
+        return self.stop
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            idx = range(*i.indices(self.stop))
+            if not idx:
+                return []
+            lo, hi = min(idx), max(idx) + 1
+            block = self.store[lo:hi]
+            return [block[j - lo] for j in idx]
+        if i < 0:
+            i += self.stop
+        if not 0 <= i < self.stop:
+            raise IndexError(i)
+        return self.store[i]
+
+class SessionStore:
+    """Chat history for one session: a bounded in-memory window plus an on-disk spill.
+
+    Each message is stored once; identical texts are interned by hash. Once
+    more than `window` messages are held, the oldest are written to SQLite at
+    `path` and dropped from memory, and are read back on demand. Spilled rows
+    are deleted when the store is cleared or garbage-collected with its session.
+    """
+
+    def __init__(self, path, window=40, session=None):
+        self.path = path
+        self.window = max(2, window)
+        self.session = session or uuid.uuid4().hex
+        self._recent = deque()
+        self._texts = {}
+        self._refs = Counter()
+        self._roles = Counter()
+        self.spilled = 0
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with _connect(path) as conn:
+            conn.executescript(_SCHEMA)
+        weakref.finalize(self, _purge, path, self.session)
+
+    def __len__(self):
+        return self.spilled + len(self._recent)
+
+    def __bool__(self):
+        return len(self) > 0
+
+    def __iter__(self):
+        yield from self._load(0, self.spilled)
+        yield from list(self._recent)
+
+    def __getitem__(self, i):
+        if isinstance(i, slice):
+            idx = range(*i.indices(len(self)))
+            if not idx:
+                return []
+            lo, hi = min(idx), max(idx) + 1
+            block = self._load(lo, min(hi, self.spilled))
+            block += list(self._recent)[max(0, lo - self.spilled):max(0, hi - self.spilled)]
+            return [block[j - lo] for j in idx]
+        if i < 0:
+            i += len(self)
+        if not 0 <= i < len(self):
+            raise IndexError(i)
+        if i >= self.spilled:
+            return self._recent[i - self.spilled]
+        return self._load(i, i + 1)[0]
+
+    def view(self, stop):
+        return _View(self, stop)
+
+    def recent(self):
+        return list(self._recent)
+
+    def count(self, role):
+        return self._roles[role]
+
+    def texts(self, role):
+        return [m.text for m in self if m.role == role]
+
+    def append(self, role, text):
+        text = str(text or "")
+        ref = text_hash(text)
+        text = self._texts.setdefault(ref, text)
+        self._refs[ref] += 1
+        self._roles[role] += 1
+        self._recent.append(Message(role, text, ref, datetime.datetime.now().isoformat()))
+        if len(self._recent) > self.window:
+            self._spill(len(self._recent) - self.window // 2)
+
+    def _spill(self, n):
+        out = [self._recent.popleft() for _ in range(n)]
+        with _connect(self.path) as conn:
+            conn.executemany("INSERT OR IGNORE INTO texts VALUES (?, ?)", [(m.ref, m.text) for m in out])
+            conn.executemany(
+                "INSERT OR REPLACE INTO messages VALUES (?, ?, ?, ?, ?)",
+                [(self.session, self.spilled + k, m.role, m.ts, m.ref) for k, m in enumerate(out)],
+            )
+        self.spilled += n
+        for m in out:
+            self._refs[m.ref] -= 1
+            if self._refs[m.ref] <= 0:
+                del self._refs[m.ref]
+                self._texts.pop(m.ref, None)
+
+    def _load(self, start, stop):
+        if stop <= start:
+            return []
+        with _connect(self.path) as conn:
+            rows = conn.execute(
+                "SELECT m.role, t.body, m.hash, m.ts FROM messages m JOIN texts t ON t.hash = m.hash "
+                "WHERE m.session=? AND m.seq>=? AND m.seq<? ORDER BY m.seq",
+                (self.session, start, stop),
+            ).fetchall()
+        return [Message(*r) for r in rows]
+
+    def put_blob(self, name, obj):
+        with _connect(self.path) as conn:
+            conn.execute("INSERT OR REPLACE INTO blobs VALUES (?, ?, ?)", (self.session, name, json.dumps(obj)))
+
+    def get_blob(self, name, default=None):
+        with _connect(self.path) as conn:
+            row = conn.execute("SELECT body FROM blobs WHERE session=? AND name=?", (self.session, name)).fetchone()
+        return json.loads(row[0]) if row else default
+
+    def clear(self):
+        _purge(self.path, self.session)
+        self._recent.clear()
+        self._texts.clear()
+        self._refs.clear()
+        self._roles.clear()
+        self.spilled = 0
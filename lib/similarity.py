@@ -0,0 +1,147 @@
+# lib/similarity.py
+import re
+import numpy as np
+import streamlit as st
+from lib.clients import SIM_GRANULARITIES as GRANULARITIES
+
+# --- Backends (SBERT → TF-IDF → difflib) ---
+SIM_BACKEND = "none"
+try:
+    from sentence_transformers import SentenceTransformer
+    @st.cache_resource
+    def _load_sbert():
+        return SentenceTransformer("all-MiniLM-L6-v2")
+    _SBERT = _load_sbert()
+    SIM_BACKEND = "sbert"
+except Exception:
+    try:
+        from sklearn.feature_extraction.text import TfidfVectorizer
+        SIM_BACKEND = "tfidf"
+    except Exception:
+        from difflib import SequenceMatcher
+        SIM_BACKEND = "difflib"
+
+# Candidate sentence ends: terminal punctuation, optional closing quotes/brackets, whitespace.
+_SENT_END = re.compile(r"[.!?][\"')\]]*\s+")
+_LAST_WORD = re.compile(r"(\S+)\.[\"')\]]*$")
+_ABBREVIATIONS = {
+    "mr", "mrs", "ms", "dr", "prof", "sr", "jr", "st", "vs", "etc", "e.g", "i.e", "cf", "al",
+    "fig", "figs", "no", "vol", "pp", "p", "ed", "eds", "approx", "dept", "inc", "ltd", "co", "jan",
+    "feb", "mar", "apr", "jun", "jul", "aug", "sep", "sept", "oct", "nov", "dec",
+}
+
+def _split_sentences(text: str):
+    """Split on . ! ? unless the period ends an abbreviation or an initial, or the next word is lowercase."""
+    out, start = [], 0
+    for m in _SENT_END.finditer(text):
+        end = m.end()
+        if end < len(text) and text[end].islower():
+            continue
+        word = _LAST_WORD.search(text[start:end].rstrip()) if text[m.start()] == "." else None
+        if word:
+            w = word.group(1).lstrip("\"'([").lower()
+            if w in _ABBREVIATIONS or (len(w) == 1 and w.isalpha()):
+                continue
+        out.append(text[start:end])
+        start = end
+    out.append(text[start:])
+    return out
+
+def excerpt(text, n=300):
+    t = text or ""
+    return t if len(t) <= n else t[:n] + " …"
+
+def segment(text: str, granularity="paragraph"):
+    """Split text into non-empty paragraphs (newline-separated) or sentences."""
+    if granularity not in GRANULARITIES:
+        raise ValueError(f"Unknown granularity {granularity!r}; expected one of {GRANULARITIES}")
+    paras = [p.strip() for p in (text or "").split("\n") if p.strip()]
+    if granularity == "paragraph":
+        return paras
+    return [s.strip() for p in paras for s in _split_sentences(p) if s.strip()]
+
+def embed(texts):
+    """Unit-norm SBERT embeddings, one row per text; only meaningful when SIM_BACKEND == "sbert"."""
+    return _SBERT.encode(list(texts), convert_to_numpy=True, normalize_embeddings=True)
+
+def _embed(finals, llm_segs):
+    """Return (F, L) such that F[a:b] @ L[c:d].T gives cosine similarities."""
+    if SIM_BACKEND == "sbert":
+        return embed(finals), embed(llm_segs)
+    # TF-IDF rows are L2-normalised, so the sparse dot product is the cosine.
+    vectorizer = TfidfVectorizer().fit(finals + llm_segs)
+    return vectorizer.transform(finals), vectorizer.transform(llm_segs).T.tocsc()
+
+def _tile(F, L, finals, llm_segs, r0, r1, c0, c1):
+    if SIM_BACKEND == "difflib":
+        return np.array([[SequenceMatcher(None, f, l).ratio() for l in llm_segs[c0:c1]]
+                         for f in finals[r0:r1]], dtype=np.float32)
+    if SIM_BACKEND == "sbert":
+        return F[r0:r1] @ L[c0:c1].T
+    return (F[r0:r1] @ L[:, c0:c1]).toarray()
+
+def top_k_similarities(finals, llm_segs, k=3, block=256, embeddings=None):
+    """Top-k LLM segments for every final segment, streamed in `block`×`block` tiles.
+
+    Only one tile plus the running (rows × k) best list is held at a time, so
+    memory stays O(block × (block + k)) regardless of input length. Returns
+    (scores, indices), both shaped (len(finals), k) and sorted descending.
+    With the SBERT backend, `embeddings=(F, L)` skips re-encoding either side.
+    """
+    n, m = len(finals), len(llm_segs)
+    k = max(1, min(k, m))
+    if SIM_BACKEND == "sbert" and embeddings is not None:
+        F, L = embeddings
+    else:
+        F, L = (None, None) if SIM_BACKEND == "difflib" else _embed(finals, llm_segs)
+
+    scores = np.empty((n, k), dtype=np.float32)
+    indices = np.empty((n, k), dtype=np.int64)
+    for r0 in range(0, n, block):
+        r1 = min(n, r0 + block)
+        best_s = np.full((r1 - r0, k), -np.inf, dtype=np.float32)
+        best_i = np.zeros((r1 - r0, k), dtype=np.int64)
+        for c0 in range(0, m, block):
+            c1 = min(m, c0 + block)
+            tile = np.asarray(_tile(F, L, finals, llm_segs, r0, r1, c0, c1), dtype=np.float32)
+            cand_s = np.concatenate([best_s, tile], axis=1)
+            cand_i = np.concatenate([best_i, np.broadcast_to(np.arange(c0, c1), tile.shape)], axis=1)
+            keep = np.argpartition(cand_s, -k, axis=1)[:, -k:]
+            best_s = np.take_along_axis(cand_s, keep, axis=1)
+            best_i = np.take_along_axis(cand_i, keep, axis=1)
+        order = np.argsort(-best_s, axis=1)
+        scores[r0:r1] = np.take_along_axis(best_s, order, axis=1)
+        indices[r0:r1] = np.take_along_axis(best_i, order, axis=1)
+    return scores, indices
+
+def compute_similarity_report(final_text, llm_texts, sim_thresh=0.85, granularity="paragraph", k=3, block=256):
+    finals = segment(final_text, granularity)
+    llm_segs = [s for t in llm_texts for s in segment(t, granularity)]
+    empty = {"backend": SIM_BACKEND, "granularity": granularity, "mean": 0.0, "high_share": 0.0, "rows": []}
+    if not finals or not llm_segs:
+        return empty
+
+    scores, indices = top_k_similarities(finals, llm_segs, k=k, block=block)
+
+    rows, high_tokens = [], 0
+    total_tokens = sum(len(s.split()) for s in finals)
+    for i, fseg in enumerate(finals):
+        s = float(scores[i, 0])
+        rows.append({
+            "final_seg": excerpt(fseg, 200),
+            "nearest_llm": excerpt(llm_segs[indices[i, 0]], 200),
+            "cosine": round(s, 3),
+            "matches": [{"llm": excerpt(llm_segs[j], 200), "cosine": round(float(c), 3)}
+                        for c, j in zip(scores[i], indices[i])],
+        })
+        if s >= sim_thresh: high_tokens += len(fseg.split())
+
+    mean_sim = round(float(scores[:, 0].mean()), 3)
+    high_share = round(high_tokens / max(1, total_tokens), 3)
+    return {**empty, "mean": mean_sim, "high_share": high_share, "rows": rows}
+
+def paginate(rows, page, page_size=25):
+    """Slice `rows` for a 1-based page; returns (page_rows, page_count)."""
+    pages = max(1, -(-len(rows) // page_size))
+    page = min(max(1, page), pages)
+    return rows[(page - 1) * page_size: page * page_size], pages
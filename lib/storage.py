@@ -2,63 +2,123 @@
 import datetime, time
 import pandas as pd
 import streamlit as st
-from lib.clients import get_spreadsheet, get_config
+from lib.clients import get_spreadsheet, get_config, WorksheetNotFound
+from lib.quota import get_governor, is_quota_error
+from lib.session_store import text_hash
 
-EVENTS_HEADERS = ["timestamp", "user_id", "assignment_id", "turn", "prompt", "response"]
+EVENTS_HEADERS = ["timestamp", "user_id", "assignment_id", "turn", "prompt", "response",
+                  "prompt_tokens", "context_tokens", "response_tokens", "raw_prompt_tokens"]
 DRAFTS_HEADERS  = ["user_id", "assignment_id", "draft_html", "draft_text", "last_updated"]
+SIMILARITY_HEADERS = ["user_id", "assignment_id", "snapshot_at", "sim_mean", "sim_high_share",
+                      "segments", "changed_segments", "backend", "computed_at"]
 
 @st.cache_resource
 def get_or_create_worksheets():
     sh = get_spreadsheet()
+    gov = get_governor()
     try:
-        events_ws = sh.worksheet("events")
-    except Exception:
-        events_ws = sh.add_worksheet(title="events", rows=1, cols=len(EVENTS_HEADERS))
-        events_ws.append_row(EVENTS_HEADERS, value_input_option="USER_ENTERED")
+        events_ws = gov.read(("worksheet", "events"), sh.worksheet, "events")
+    except WorksheetNotFound:
+        events_ws = gov.write(sh.add_worksheet, title="events", rows=1, cols=len(EVENTS_HEADERS))
+        gov.write(events_ws.append_row, EVENTS_HEADERS, value_input_option="USER_ENTERED")
+    _ensure_headers(events_ws, EVENTS_HEADERS)
     try:
-        drafts_ws = sh.worksheet("drafts")
-    except Exception:
-        drafts_ws = sh.add_worksheet(title="drafts", rows=1, cols=len(DRAFTS_HEADERS))
-        drafts_ws.append_row(DRAFTS_HEADERS, value_input_option="USER_ENTERED")
+        drafts_ws = gov.read(("worksheet", "drafts"), sh.worksheet, "drafts")
+    except WorksheetNotFound:
+        drafts_ws = gov.write(sh.add_worksheet, title="drafts", rows=1, cols=len(DRAFTS_HEADERS))
+        gov.write(drafts_ws.append_row, DRAFTS_HEADERS, value_input_option="USER_ENTERED")
     return events_ws, drafts_ws
 
-def append_row_safe(ws, row):
-    """Avoid 'Unable to parse range' by calculating next row and updating directly."""
+@st.cache_resource
+def get_similarity_worksheet():
+    sh = get_spreadsheet()
+    gov = get_governor()
+    try:
+        return gov.read(("worksheet", "similarity"), sh.worksheet, "similarity")
+    except WorksheetNotFound:
+        sim_ws = gov.write(sh.add_worksheet, title="similarity", rows=1, cols=len(SIMILARITY_HEADERS))
+        gov.write(sim_ws.append_row, SIMILARITY_HEADERS, value_input_option="USER_ENTERED")
+        return sim_ws
+
+def _ensure_headers(ws, headers):
+    """Append any header columns added since the sheet was created."""
+    gov = get_governor()
+    try:
+        current = gov.read((ws.title, "header"), ws.row_values, 1)
+        missing = [h for h in headers if h not in current]
+        if missing:
+            if ws.col_count < len(current) + len(missing):
+                gov.write(ws.add_cols, len(current) + len(missing) - ws.col_count)
+            gov.write(ws.update, "A1", [current + missing], value_input_option="USER_ENTERED")
+    except Exception as e:
+        st.warning(f"Header check failed for '{ws.title}': {e}")
+
+def get_records(ws, headers):
+    """Governed `get_all_records`; concurrent reads of the same sheet share one request."""
+    return get_governor().read(
+        (ws.title, "records"), ws.get_all_records,
+        expected_headers=headers, head=1, default_blank="",
+    )
+
+def append_row(ws, row):
+    """Governed append that raises on failure; safe to call from background threads.
+
+    Avoids 'Unable to parse range' by calculating next row and updating directly.
+    """
+    gov = get_governor()
     try:
-        ws.append_row(row, value_input_option="USER_ENTERED")
+        gov.write(ws.append_row, row, value_input_option="USER_ENTERED")
         return
-    except Exception:
-        pass
+    except Exception as e:
+        # Only a range-parse failure is worth the extra read + write; anything
+        # else (notably an exhausted 429) would just fail again.
+        if is_quota_error(e) or "Unable to parse range" not in str(e):
+            raise
+    current = gov.read((ws.title, "values"), ws.get_all_values)
+    next_row = len(current) + 1
+    if next_row > ws.row_count:
+        gov.write(ws.add_rows, max(10, next_row - ws.row_count))
+    gov.write(ws.update, f"A{next_row}", [row], value_input_option="USER_ENTERED")
+
+def append_row_safe(ws, row):
+    """`append_row` that reports failure with st.warning; returns True if the row was written."""
     try:
-        current = ws.get_all_values()
-        next_row = len(current) + 1
-        if next_row > ws.row_count:
-            ws.add_rows(max(10, next_row - ws.row_count))
-        ws.update(f"A{next_row}", [row], value_input_option="USER_ENTERED")
-    except Exception as e2:
-        st.warning(f"Append failed: {e2}")
+        append_row(ws, row)
+        return True
+    except Exception as e:
+        st.warning(f"Append failed: {e}")
+        return False
 
 def save_draft_row(drafts_ws, user_id, assignment_id, draft_html):
     from lib.ui import html_to_text
+    from lib.pipeline import get_pipeline
     draft_text = html_to_text(draft_html)
-    append_row_safe(drafts_ws, [
-        user_id, assignment_id, draft_html, draft_text, datetime.datetime.now().isoformat()
-    ])
+    snapshot_at = datetime.datetime.now().isoformat()
+    if not append_row_safe(drafts_ws, [
+        user_id, assignment_id, draft_html, draft_text, snapshot_at
+    ]):
+        return False
+    # Only snapshots that exist in the drafts sheet get a similarity row.
+    get_pipeline().submit(user_id, assignment_id, draft_text, snapshot_at)
     st.session_state["last_saved_at"] = datetime.datetime.now()
-    st.session_state["last_saved_html"] = draft_html
+    st.session_state["last_saved_hash"] = text_hash(draft_html)
+    return True
 
 def load_last_draft(drafts_ws, user_id, assignment_id):
     try:
-        recs = drafts_ws.get_all_records(expected_headers=DRAFTS_HEADERS, head=1, default_blank="")
+        recs = get_records(drafts_ws, DRAFTS_HEADERS)
         for r in reversed(recs):
             if str(r.get("user_id","")).strip().upper() == str(user_id).strip().upper() and \
                str(r.get("assignment_id","")).strip() == str(assignment_id).strip():
                 return r.get("draft_html") or ""
-    except Exception:
+    except Exception as e:
+        if is_quota_error(e):
+            raise
         return ""
     return ""
 
-def log_turn_row(events_ws, user_id, assignment_id, prompt, response, turn):
+def log_turn_row(events_ws, user_id, assignment_id, prompt, response, turn, tokens=None):
+    tokens = tokens or {}
     append_row_safe(events_ws, [
         datetime.datetime.now().isoformat(),
         user_id,
@@ -66,13 +126,17 @@ def log_turn_row(events_ws, user_id, assignment_id, prompt, response, turn):
         turn,
         str(prompt)[:10000],
         str(response)[:10000],
+        tokens.get("prompt_tokens", ""),
+        tokens.get("context_tokens", ""),
+        tokens.get("response_tokens", ""),
+        tokens.get("raw_prompt_tokens", ""),
     ])
 
 @st.cache_data(ttl=60)
 def get_known_student_ids():
     _, drafts_ws = get_or_create_worksheets()
     try:
-        recs = drafts_ws.get_all_records(expected_headers=DRAFTS_HEADERS, head=1, default_blank="")
+        recs = get_records(drafts_ws, DRAFTS_HEADERS)
         if not recs: return set()
         return set(pd.DataFrame(recs)["user_id"].astype(str).unique())
     except Exception:
@@ -81,6 +145,10 @@ def get_known_student_ids():
 @st.cache_data(ttl=300)
 def get_student_dataframes():
     events_ws, drafts_ws = get_or_create_worksheets()
-    drafts = pd.DataFrame(drafts_ws.get_all_records(expected_headers=DRAFTS_HEADERS, head=1, default_blank=""))
-    events = pd.DataFrame(events_ws.get_all_records(expected_headers=EVENTS_HEADERS, head=1, default_blank=""))
+    drafts = pd.DataFrame(get_records(drafts_ws, DRAFTS_HEADERS))
+    events = pd.DataFrame(get_records(events_ws, EVENTS_HEADERS))
     return drafts, events
+
+@st.cache_data(ttl=300)
+def get_similarity_dataframe():
+    return pd.DataFrame(get_records(get_similarity_worksheet(), SIMILARITY_HEADERS))
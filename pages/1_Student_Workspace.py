@@ -6,6 +6,10 @@ from streamlit.components.v1 import html as st_html
 
 from lib.ui import inject_css, md_to_html, html_to_text
 from lib.clients import get_config, get_llm_client
+from lib.quota import is_quota_error
+from lib.context import build_context, estimate_tokens
+from lib.similarity import SIM_BACKEND, GRANULARITIES, compute_similarity_report, paginate
+from lib.session_store import SessionStore, text_hash
 from lib.storage import (
     get_or_create_worksheets, append_row_safe, save_draft_row, load_last_draft,
     log_turn_row
@@ -19,14 +23,18 @@ EVENTS_WS, DRAFTS_WS = get_or_create_worksheets()
 
 # Session defaults
 st.session_state.setdefault("assignment_id", cfg["ASSIGNMENT_DEFAULT"])
-st.session_state.setdefault("chat", [])
-st.session_state.setdefault("llm_outputs", [])
+if not isinstance(st.session_state.get("chat"), SessionStore):
+    st.session_state["chat"] = SessionStore(cfg["SESSION_SPILL_PATH"], window=cfg["SESSION_WINDOW_MESSAGES"])
 st.session_state.setdefault("draft_html", "")
-st.session_state.setdefault("report", None)
+st.session_state.setdefault("report", None)  # summary + segment count; rows live in the chat store's "report" blob
 st.session_state.setdefault("last_saved_at", None)
 st.session_state.setdefault("last_autosave_at", None)
-st.session_state.setdefault("last_saved_html", "")
+st.session_state.setdefault("last_saved_hash", text_hash(""))
+st.session_state.setdefault("show_full_history", False)
 st.session_state.setdefault("pending_prompt", None)
+st.session_state.setdefault("context_summary", None)
+st.session_state.setdefault("sim_granularity", cfg["SIM_GRANULARITY"])
+st.session_state.setdefault("sim_page", 1)
 
 # Require auth
 if not st.session_state.get("__auth_ok"):
@@ -35,70 +43,7 @@ if not st.session_state.get("__auth_ok"):
 
 LLM = get_llm_client()
 
-def excerpt(text, n=300):
-    t = text or ""
-    return t if len(t) <= n else t[:n] + " …"
-
-# --- Similarity helpers (SBERT → TF-IDF → difflib) ---
 SIM_THRESHOLD = cfg["SIM_THRESHOLD"]
-SIM_BACKEND = "none"
-try:
-    from sentence_transformers import SentenceTransformer, util as sbert_util
-    @st.cache_resource
-    def _load_sbert():
-        return SentenceTransformer("all-MiniLM-L6-v2")
-    _SBERT = _load_sbert()
-    SIM_BACKEND = "sbert"
-except Exception:
-    try:
-        from sklearn.feature_extraction.text import TfidfVectorizer
-        from sklearn.metrics.pairwise import cosine_similarity
-        SIM_BACKEND = "tfidf"
-    except Exception:
-        from difflib import SequenceMatcher
-        SIM_BACKEND = "difflib"
-
-def _segment(text: str):
-    return [p.strip() for p in (text or "").split("\n") if p.strip()]
-
-def compute_similarity_report(final_text, llm_texts, sim_thresh=SIM_THRESHOLD):
-    finals = _segment(final_text)
-    llm_segs = [s for t in llm_texts for s in _segment(t)]
-    if not finals or not llm_segs:
-        return {"backend": SIM_BACKEND, "mean": 0.0, "high_share": 0.0, "rows": []}
-
-    rows, high_tokens = [], 0
-    total_tokens = sum(len(s.split()) for s in finals)
-
-    if SIM_BACKEND == "sbert":
-        Ef = _SBERT.encode(finals, convert_to_tensor=True, normalize_embeddings=True)
-        El = _SBERT.encode(llm_segs, convert_to_tensor=True, normalize_embeddings=True)
-        sims = sbert_util.cos_sim(Ef, El).cpu().numpy()
-        for i, fseg in enumerate(finals):
-            j = int(sims[i].argmax()); s = float(sims[i, j]); nearest = llm_segs[j]
-            rows.append({"final_seg": excerpt(fseg, 200), "nearest_llm": excerpt(nearest, 200), "cosine": round(s, 3)})
-            if s >= sim_thresh: high_tokens += len(fseg.split())
-    elif SIM_BACKEND == "tfidf":
-        vectorizer = TfidfVectorizer().fit(finals + llm_segs)
-        F = vectorizer.transform(finals); L = vectorizer.transform(llm_segs)
-        sims = cosine_similarity(F, L)
-        for i, fseg in enumerate(finals):
-            j = int(sims[i].argmax()); s = float(sims[i, j]); nearest = llm_segs[j]
-            rows.append({"final_seg": excerpt(fseg, 200), "nearest_llm": excerpt(nearest, 200), "cosine": round(s, 3)})
-            if s >= sim_thresh: high_tokens += len(fseg.split())
-    else:
-        def cos_like(a,b): return SequenceMatcher(None,a,b).ratio()
-        for fseg in finals:
-            best, near = 0.0, ""
-            for l in llm_segs:
-                c = cos_like(fseg,l)
-                if c>best: best, near = c, l
-            rows.append({"final_seg": excerpt(fseg,200), "nearest_llm": excerpt(near,200), "cosine": round(best,3)})
-            if best >= sim_thresh: high_tokens += len(fseg.split())
-
-    mean_sim = 0.0 if not rows else round(sum(r["cosine"] for r in rows) / len(rows), 3)
-    high_share = round(high_tokens / max(1, total_tokens), 3)
-    return {"backend": SIM_BACKEND, "mean": mean_sim, "high_share": high_share, "rows": rows[:30]}
 
 # --- LLM ---
 def ask_llm(prompt_text: str):
@@ -114,7 +59,7 @@ def ask_llm(prompt_text: str):
 def maybe_autosave():
     now = time.time()
     last_ts = st.session_state.get("last_autosave_at") or 0
-    changed = (st.session_state.draft_html or "") != (st.session_state.last_saved_html or "")
+    changed = text_hash(st.session_state.draft_html) != st.session_state.last_saved_hash
     if changed and (now - last_ts) >= cfg["AUTO_SAVE_SECONDS"]:
         save_draft_row(DRAFTS_WS,
                        st.session_state.user_id,
@@ -141,17 +86,24 @@ with t1:
     st.session_state["assignment_id"] = st.text_input("Assignment ID", value=st.session_state["assignment_id"])
 with t2:
     if st.button("🔄 Load Last Draft", use_container_width=True):
-        html = load_last_draft(DRAFTS_WS, st.session_state["user_id"], st.session_state["assignment_id"])
+        try:
+            html = load_last_draft(DRAFTS_WS, st.session_state["user_id"], st.session_state["assignment_id"])
+        except Exception as e:
+            if not is_quota_error(e):
+                raise
+            html = None
+            st.warning("The storage backend is busy right now. Please try loading your draft again in a minute.")
         if html:
             st.session_state["draft_html"] = html
             st.success("Loaded last saved draft.")
             st.rerun()
-        else:
+        elif html is not None:
             st.warning("No saved draft found.")
 with t3:
     if st.button("🧹 Clear Chat", use_container_width=True):
-        st.session_state["chat"] = []
-        st.session_state["llm_outputs"] = []
+        st.session_state["chat"].clear()
+        st.session_state["report"] = None
+        st.session_state["context_summary"] = None
         st.toast("Chat cleared")
 
 left, right = st.columns([0.5, 0.5], gap="large")
@@ -160,11 +112,15 @@ left, right = st.columns([0.5, 0.5], gap="large")
 with left:
     st.subheader("💬 Assistant")
 
-    if not st.session_state["chat"]:
+    chat = st.session_state["chat"]
+    if chat.spilled:
+        st.toggle(f"Show full history ({chat.spilled} earlier messages)", key="show_full_history")
+
+    if not chat:
         bubbles_html = '<div class="chat-empty">Ask for ideas, critique, or examples.</div>'
     else:
         out = []
-        for m in st.session_state["chat"]:
+        for m in (chat if st.session_state["show_full_history"] else chat.recent()):
             css = "chat-user" if m["role"] == "user" else "chat-assistant"
             content = md_to_html(m["text"]) if m["role"] == "assistant" \
                      else _html.escape(m["text"]).replace("\n", "<br>")
@@ -188,7 +144,7 @@ with left:
             send = st.form_submit_button("Send")
 
     if send and (prompt or "").strip():
-        st.session_state["chat"].append({"role": "user", "text": prompt})
+        st.session_state["chat"].append("user", prompt)
         st.session_state["pending_prompt"] = prompt
         st.rerun()
 
@@ -196,16 +152,23 @@ with left:
         with st.spinner("Generating response…"):
             p = st.session_state["pending_prompt"]
             st.session_state["pending_prompt"] = None
-            reply = ask_llm(p)
-            st.session_state["chat"].append({"role": "assistant", "text": reply})
-            st.session_state["llm_outputs"].append(reply)
+            context, tokens = build_context(
+                p,
+                st.session_state["chat"].view(len(st.session_state["chat"]) - 1),
+                html_to_text(st.session_state["draft_html"]),
+                cfg["CONTEXT_TOKEN_BUDGET"],
+            )
+            reply = ask_llm(context)
+            tokens["response_tokens"] = estimate_tokens(reply)
+            st.session_state["chat"].append("assistant", reply)
 
             # Log the single consolidated turn
             log_turn_row(EVENTS_WS,
                          st.session_state["user_id"],
                          st.session_state["assignment_id"],
                          p, reply,
-                         turn=sum(1 for m in st.session_state["chat"] if m["role"] == "user"))
+                         turn=st.session_state["chat"].count("user"),
+                         tokens=tokens)
         st.rerun()
 
 # --- Right: Draft ---
@@ -226,22 +189,23 @@ with right:
     c1, c2, c3 = st.columns(3)
     with c1:
         if st.button("💾 Save Draft", use_container_width=True):
-            save_draft_row(DRAFTS_WS, st.session_state["user_id"],
-                           st.session_state["assignment_id"], st.session_state["draft_html"])
-            st.session_state["last_saved_at"] = datetime.datetime.now()
-            st.session_state["last_saved_html"] = st.session_state["draft_html"]
-            st.toast("Draft saved")
+            if save_draft_row(DRAFTS_WS, st.session_state["user_id"],
+                              st.session_state["assignment_id"], st.session_state["draft_html"]):
+                st.toast("Draft saved")
 
     with c2:
         if st.button("📊 Run Similarity", use_container_width=True):
             plain = html_to_text(st.session_state["draft_html"])
-            if plain.strip() and st.session_state["llm_outputs"]:
-                report = compute_similarity_report(plain, st.session_state["llm_outputs"], SIM_THRESHOLD)
-                st.session_state["report"] = report
-                st.success(f"Mean: {report['mean']} | High-sim: {report['high_share']*100:.1f}%")
-                with st.expander("Matches (trimmed)"):
-                    for r in report["rows"]:
-                        st.markdown(f"- **Cos:** {r['cosine']}  \n  **Final:** {r['final_seg']}  \n  **LLM:** {r['nearest_llm']}")
+            if plain.strip() and st.session_state["chat"].count("assistant"):
+                report = compute_similarity_report(
+                    plain, st.session_state["chat"].texts("assistant"), SIM_THRESHOLD,
+                    granularity=st.session_state["sim_granularity"],
+                    k=cfg["SIM_TOP_K"], block=cfg["SIM_BLOCK_SIZE"],
+                )
+                st.session_state["chat"].put_blob("report", report["rows"])
+                summary = {k: v for k, v in report.items() if k != "rows"}
+                st.session_state["report"] = {**summary, "segments": len(report["rows"])}
+                st.session_state["sim_page"] = 1
             else:
                 st.warning("Need draft text + at least one LLM response.")
 
@@ -249,7 +213,7 @@ with right:
         if st.button("⬇️ Export Evidence (DOCX)", use_container_width=True):
             try:
                 import docx
-                def export_docx(user_id, assign_id, chat, draft_html, report):
+                def export_docx(user_id, assign_id, chat, draft_html, report, report_rows):
                     final_text = html_to_text(draft_html)
                     d = docx.Document()
                     d.add_heading("Coursework Evidence Pack", 0)
@@ -263,18 +227,19 @@ with right:
                     d.add_heading("Final Draft (plain text extract)", level=1)
                     for para in final_text.split("\n"):
                         d.add_paragraph(para)
-                    rep = report or {"backend":"-","mean":0.0,"high_share":0.0,"rows":[]}
+                    rep = report or {"backend":"-","mean":0.0,"high_share":0.0}
                     d.add_heading("Similarity Report", level=1)
                     d.add_paragraph(f"Backend: {rep.get('backend','-')}")
                     d.add_paragraph(f"Mean similarity: {rep.get('mean',0.0)}")
                     d.add_paragraph(f"High-sim share: {rep.get('high_share',0.0)*100:.1f}%")
-                    for r in rep.get("rows", []):
+                    for r in report_rows:
                         d.add_paragraph(f"- Cosine: {r['cosine']} | Final: {r['final_seg']} | LLM: {r['nearest_llm']}")
                     buf = io.BytesIO(); d.save(buf); buf.seek(0); return buf.read()
 
                 data = export_docx(st.session_state["user_id"], st.session_state["assignment_id"],
                                    st.session_state["chat"], st.session_state["draft_html"],
-                                   st.session_state.get("report"))
+                                   st.session_state.get("report"),
+                                   st.session_state["chat"].get_blob("report", []))
                 st.download_button(
                     "Download DOCX",
                     data=data,
@@ -284,3 +249,18 @@ with right:
                 )
             except Exception as e:
                 st.error(f"Export failed: {e}")
+
+    st.radio("Similarity granularity", GRANULARITIES, key="sim_granularity", horizontal=True)
+
+    report = st.session_state.get("report")
+    if report:
+        st.success(f"Mean: {report['mean']} | High-sim: {report['high_share']*100:.1f}% "
+                   f"({report['segments']} {report.get('granularity', 'paragraph')} segments)")
+        with st.expander("Matches", expanded=True):
+            all_rows = st.session_state["chat"].get_blob("report", [])
+            _, pages = paginate(all_rows, 1)
+            page = st.number_input("Page", min_value=1, max_value=pages, key="sim_page")
+            rows, _ = paginate(all_rows, page)
+            for r in rows:
+                alts = "".join(f"  \n  *Also:* {m['cosine']} — {m['llm']}" for m in r.get("matches", [])[1:])
+                st.markdown(f"- **Cos:** {r['cosine']}  \n  **Final:** {r['final_seg']}  \n  **LLM:** {r['nearest_llm']}{alts}")
@@ -1,10 +1,12 @@
 # pages/2_Academic_Dashboard.py
+import time
 import pandas as pd
 import streamlit as st
 from streamlit.components.v1 import html as st_html
 
 from lib.ui import inject_css, md_to_html
-from lib.storage import get_student_dataframes
+from lib.storage import get_student_dataframes, get_similarity_dataframe
+from lib.search import get_search_index
 
 st.set_page_config(page_title="Academic Dashboard", layout="wide")
 inject_css()
@@ -24,6 +26,39 @@ if drafts_df.empty and events_df.empty:
     st.warning("No student data recorded yet.")
     st.stop()
 
+# Cohort-wide search over prompts and responses
+index = get_search_index()
+if len(events_df) != index.n_rows:
+    index.sync_in_background(events_df)
+with st.expander("🔎 Search all prompts & responses"):
+    if index.syncing or len(events_df) != index.n_rows:
+        st.caption(f"Indexing new turns… {index.n_rows}/{len(events_df)} searchable so far.")
+    q = st.text_input("Query", placeholder='Words, or "an exact phrase"')
+    f1, f2, f3, f4 = st.columns(4)
+    with f1:
+        s_field = st.selectbox("In", ["Prompts & responses", "Prompts", "Responses"])
+    with f2:
+        all_assignments = sorted(events_df.get('assignment_id', pd.Series(dtype=str)).dropna().astype(str).unique().tolist())
+        s_aid = st.selectbox("Assignment", ["(All)"] + all_assignments)
+    with f3:
+        s_from = st.date_input("From", value=None)
+    with f4:
+        s_to = st.date_input("To", value=None)
+    if q.strip():
+        t0 = time.perf_counter()
+        hits = index.search(
+            q,
+            field={"Prompts": "prompt", "Responses": "response"}.get(s_field),
+            assignment=None if s_aid == "(All)" else s_aid,
+            date_from=s_from, date_to=s_to,
+        )
+        st.caption(f"{len(hits)} result(s) in {(time.perf_counter() - t0) * 1000:.1f} ms")
+        for h in hits:
+            text = str(events_df.iloc[h["row"]].get(h["field"], ""))
+            st.markdown(f"**{h['user_id']}** · {h['assignment_id']} · Turn {h['turn']} · {h['timestamp']} · "
+                        f"_{h['field']}_ · score {h['score']}")
+            st.caption(text[:400] + (" …" if len(text) > 400 else ""))
+
 # Choose student and optional assignment filter
 all_ids = sorted(
     {*(drafts_df.get('user_id', pd.Series(dtype=str)).dropna().astype(str)),
@@ -47,6 +82,19 @@ if aid and aid!="(All)":
     s_events = s_events[s_events['assignment_id']==aid]
     s_drafts = s_drafts[s_drafts['assignment_id']==aid]
 
+sim_df = get_similarity_dataframe()
+if not sim_df.empty:
+    s_sim = sim_df[sim_df['user_id'].astype(str)==sid]
+    if aid and aid!="(All)":
+        s_sim = s_sim[s_sim['assignment_id']==aid]
+    if not s_sim.empty:
+        st.subheader("Writing Alignment Over Time")
+        chart = pd.DataFrame({
+            "Mean similarity": pd.to_numeric(s_sim['sim_mean'], errors="coerce").values,
+            "High-sim share": pd.to_numeric(s_sim['sim_high_share'], errors="coerce").values,
+        }, index=pd.to_datetime(s_sim['snapshot_at'], errors="coerce")).sort_index()
+        st.line_chart(chart)
+
 col1, col2 = st.columns(2)
 with col1:
     st.subheader("Latest Draft")